@@ -1,8 +1,14 @@
+import math
 import torch
+import torch.nn.functional as F
 from torch.nn import Module, Linear
 from torch.optim.lr_scheduler import LambdaLR
 import numpy as np
 
+# Resolved once at import so `SelfAttention` stays compatible with `torch.jit.script`.
+HAS_SDPA = hasattr(F, 'scaled_dot_product_attention')
+
+
 def reparameterize_gaussian(mean, logvar):
     std = torch.exp(0.5 * logvar)
     eps = torch.randn(std.size()).to(mean)
@@ -21,6 +27,18 @@ def standard_normal_logprob(z):
     return log_z - z.pow(2) / 2
 
 
+def fold_linear_bn(linear, bn):
+    """
+    Folds a Linear layer followed by an eval-mode BatchNorm1d into a single affine map.
+    Returns:
+        weight (out, in) and bias (out, ) of the equivalent Linear layer.
+    """
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    weight = linear.weight * scale.unsqueeze(1)
+    bias = (linear.bias - bn.running_mean) * scale + bn.bias
+    return weight, bias
+
+
 def truncated_normal_(tensor, mean=0, std=1, trunc_std=2):
     """
     Taken from https://discuss.pytorch.org/t/implementing-truncated-normal-initializer/4778/15
@@ -51,6 +69,48 @@ class ConcatSquashLinear(Module):
         return ret
 
 
+class SelfAttention(Module):
+    """
+    Multi-head self-attention on batch-first inputs (B, L, d). q/k/v come from one fused projection
+    and are fed to `F.scaled_dot_product_attention` as explicitly laid out (B, H, L, d/H) heads.
+    Unlike `nn.MultiheadAttention` it can be scripted with `torch.jit.script` and cast with `.half()`.
+    """
+    def __init__(self, dim, num_heads):
+        super(SelfAttention, self).__init__()
+        assert dim % num_heads == 0, '`dim` must be divisible by `num_heads`.'
+        self.num_heads = num_heads
+        self.in_proj = Linear(dim, 3*dim)   # Stacked q/k/v projections
+        self.out_proj = Linear(dim, dim)
+
+    def _split_heads(self, x: torch.Tensor) -> torch.Tensor:
+        B, L, d = x.size()
+        return x.view(B, L, self.num_heads, d // self.num_heads).transpose(1, 2).contiguous()
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        B, L, d = x.size()
+        q, k, v = self.in_proj(x).chunk(3, dim=-1)
+        q, k, v = self._split_heads(q), self._split_heads(k), self._split_heads(v)
+        if HAS_SDPA:
+            out = F.scaled_dot_product_attention(q, k, v)
+        else:
+            attn = torch.softmax(q @ k.transpose(-2, -1) / math.sqrt(q.size(-1)), dim=-1)
+            out = attn @ v
+        out = out.transpose(1, 2).reshape(B, L, d)
+        return self.out_proj(out)
+
+    def collapse(self):
+        """
+        With a length-1 sequence every token attends only to itself, so the layer reduces to
+        out_proj(v_proj(x)).
+        Returns:
+            weight (d, d) and bias (d, ) of the equivalent Linear layer.
+        """
+        d = self.out_proj.weight.size(0)
+        weight = self.out_proj.weight @ self.in_proj.weight[2*d:]
+        bias = self.out_proj.weight @ self.in_proj.bias[2*d:] + self.out_proj.bias
+        return weight, bias
+
+
 def get_linear_scheduler(optimizer, start_epoch, end_epoch, start_lr, end_lr):
     def lr_func(epoch):
         if epoch <= start_epoch:
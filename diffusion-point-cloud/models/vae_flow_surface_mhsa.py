@@ -1,3 +1,4 @@
+import math
 import torch
 from torch.nn import Module
 
@@ -19,7 +20,21 @@ class FlowVAESurfaceConditional(Module):
         self.BN1 = nn.BatchNorm1d(int(args.latent_dim/2))
         self.FC2 = nn.Linear(int(args.latent_dim/2), args.latent_dim)
         self.BN2 = nn.BatchNorm1d(args.latent_dim)
-        self.MHSA = nn.MultiheadAttention(args.latent_dim, 2)
+        self.attn = SelfAttention(args.latent_dim, 2)
+        # FC1/BN1/FC2/BN2/attn folded into one affine map, see `fuse_for_inference`.
+        # Non-persistent buffers: they follow `.to()`/`.half()` but stay out of `state_dict()`.
+        self.register_buffer('_fused_weight', None, persistent=False)
+        self.register_buffer('_fused_bias', None, persistent=False)
+        # Constant terms of `gaussian_entropy` and of `standard_normal_logprob` summed over the latent dims
+        self.entropy_const = 0.5 * args.latent_dim * (1. + math.log(2 * math.pi))
+        self.log_pw_const = -0.5 * args.latent_dim * args.latent_dim * math.log(2 * math.pi)
+        self._zeros = None  # Reused zero log-det accumulator for the flow, see `get_loss`
+        self._encode_cond_compiled = None
+        if getattr(args, 'compile', False):
+            # Graph-capture the small conditioning kernels. Not meant for nn.DataParallel, which builds new
+            # replicas every forward and would keep invalidating the compiled graph; the training script
+            # turns `compile` off when it replicates the model.
+            self._encode_cond_compiled = torch.compile(FlowVAESurfaceConditional._encode_cond_impl, mode='reduce-overhead', fullgraph=True)
 
         self.flow = build_latent_flow(args)
         self.diffusion = DiffusionPoint(
@@ -34,6 +49,16 @@ class FlowVAESurfaceConditional(Module):
 
     def load_partial_state_dict(self, state_dict):
         model_state_dict = self.state_dict()
+        # Map older attention layouts onto the fused `attn.in_proj` projection
+        state_dict = dict(state_dict)
+        if 'MHSA.in_proj_weight' in state_dict:
+            state_dict['attn.in_proj.weight'] = state_dict['MHSA.in_proj_weight']
+            state_dict['attn.in_proj.bias'] = state_dict['MHSA.in_proj_bias']
+            state_dict['attn.out_proj.weight'] = state_dict['MHSA.out_proj.weight']
+            state_dict['attn.out_proj.bias'] = state_dict['MHSA.out_proj.bias']
+        if 'attn.q_proj.weight' in state_dict:
+            for param in ('weight', 'bias'):
+                state_dict['attn.in_proj.' + param] = torch.cat([state_dict['attn.%s_proj.%s' % (p, param)] for p in 'qkv'], dim=0)
         filtered_state_dict = {k: v for k, v in state_dict.items() if k in model_state_dict}
 
         # Update the model's state_dict with the filtered state_dict
@@ -42,6 +67,45 @@ class FlowVAESurfaceConditional(Module):
         # Load the updated state_dict into your model
         self.load_state_dict(model_state_dict, strict=False)
 
+    def _load_from_state_dict(self, *args, **kwargs):
+        # New weights invalidate any previously fused projection. Hooked here rather than in
+        # `load_state_dict` so loading through a DataParallel wrapper clears it as well.
+        self._fused_weight = self._fused_bias = None
+        super()._load_from_state_dict(*args, **kwargs)
+
+    def train(self, mode=True):
+        # The fused projection is only valid for the BN running statistics it was built from.
+        if mode:
+            self._fused_weight = self._fused_bias = None
+        return super().train(mode)
+
+    @torch.no_grad()
+    def fuse_for_inference(self):
+        """
+        Switches to eval mode and folds FC1/BN1/FC2/BN2/attn into a single affine map,
+        used by `sample` until the model is put back into training mode or reloaded.
+        """
+        self.eval()
+        W1, b1 = fold_linear_bn(self.FC1, self.BN1)
+        W2, b2 = fold_linear_bn(self.FC2, self.BN2)
+        W3, b3 = self.attn.collapse()
+        self._fused_weight = W3 @ W2 @ W1
+        self._fused_bias = W3 @ (W2 @ b1 + b2) + b3
+        return self
+
+    def _encode_cond_impl(self, z, view_angle, yaw):
+        # Encode the view angle and yaw into the latent code through the self-attention block.
+        z = torch.cat([z, view_angle, yaw], dim=1)
+        z = self.BN1(self.FC1(z))
+        z = self.BN2(self.FC2(z))
+        z = self.attn(z.unsqueeze(1)).squeeze(1)
+        return z
+
+    def _encode_cond(self, z, view_angle, yaw):
+        if self._encode_cond_compiled is not None:
+            return self._encode_cond_compiled(self, z, view_angle, yaw)
+        return self._encode_cond_impl(z, view_angle, yaw)
+
     def get_loss(self, x, view_angle, yaw, kl_weight, writer=None, it=None):
         """
         Args:
@@ -49,6 +113,12 @@ class FlowVAESurfaceConditional(Module):
             view_angle:  View angle, (B, 1).
             yaw:  Yaw, (B, 1).
         """
+        # Optional bf16 autocast on CUDA; the returned loss is always fp32.
+        with torch.autocast('cuda', dtype=torch.bfloat16, enabled=getattr(self.args, 'amp', False) and x.is_cuda):
+            loss = self._get_loss(x, view_angle, yaw, kl_weight, writer=writer, it=it)
+        return loss.float()
+
+    def _get_loss(self, x, view_angle, yaw, kl_weight, writer=None, it=None):
         batch_size, _, _ = x.size()
         # print(x.size())
 
@@ -56,19 +126,16 @@ class FlowVAESurfaceConditional(Module):
         z = reparameterize_gaussian(mean=z_mu, logvar=z_sigma)  # (B, F)
 
         # Add MHSA layer to encode the view angle and yaw.
-        z = torch.cat([z, view_angle, yaw], dim=1)
-        z = self.BN1(self.FC1(z))
-        z = self.BN2(self.FC2(z))
-        z = z.unsqueeze(1)
-        z = self.MHSA(z, z, z)
-        z = z.squeeze(1)
+        z = self._encode_cond(z, view_angle, yaw)
                 
         # H[Q(z|X)]
-        entropy = gaussian_entropy(logvar=z_sigma)      # (B, )
+        entropy = 0.5 * z_sigma.sum(dim=1) + self.entropy_const      # (B, )
 
         # P(z), Prior probability, parameterized by the flow: z -> w.
-        w, delta_log_pw = self.flow(z, torch.zeros([batch_size, 1]).to(z), reverse=False)
-        log_pw = standard_normal_logprob(w).view(batch_size, -1).sum(dim=1, keepdim=True)   # (B, 1)
+        if self._zeros is None or self._zeros.size(0) < batch_size or self._zeros.device != z.device or self._zeros.dtype != z.dtype:
+            self._zeros = torch.zeros([batch_size, 1], device=z.device, dtype=z.dtype)
+        w, delta_log_pw = self.flow(z, self._zeros[:batch_size], reverse=False)
+        log_pw = self.log_pw_const - 0.5 * w.pow(2).view(batch_size, -1).sum(dim=1, keepdim=True)   # (B, 1)
         log_pz = log_pw - delta_log_pw.view(batch_size, 1)  # (B, 1)
 
         # Negative ELBO of P(X|z)
@@ -80,13 +147,14 @@ class FlowVAESurfaceConditional(Module):
         loss_recons = neg_elbo
         loss = kl_weight*(loss_entropy + loss_prior) + neg_elbo
 
-        if writer is not None:
-            writer.add_scalar('train/loss_entropy', loss_entropy, it)
-            writer.add_scalar('train/loss_prior', loss_prior, it)
-            writer.add_scalar('train/loss_recons', loss_recons, it)
-            writer.add_scalar('train/z_mean', z_mu.mean(), it)
-            writer.add_scalar('train/z_mag', z_mu.abs().max(), it)
-            writer.add_scalar('train/z_var', (0.5*z_sigma).exp().mean(), it)
+        if writer is not None and (it is None or it % getattr(self.args, 'log_freq', 1) == 0):
+            # Gather all logged statistics with a single device sync
+            stats = torch.stack([
+                loss_entropy, loss_prior, loss_recons,
+                z_mu.mean(), z_mu.abs().max(), (0.5*z_sigma).exp().mean()
+            ]).detach().cpu().tolist()
+            for tag, value in zip(('loss_entropy', 'loss_prior', 'loss_recons', 'z_mean', 'z_mag', 'z_var'), stats):
+                writer.add_scalar('train/' + tag, value, it)
 
         return loss
 
@@ -96,12 +164,10 @@ class FlowVAESurfaceConditional(Module):
             w = truncated_normal_(w, mean=0, std=1, trunc_std=truncate_std)
         # Reverse: z <- w.
         z = self.flow(w, reverse=True).view(batch_size, -1)
-        z = torch.cat([z, view_angle, yaw], dim=1)
-        z = self.BN1(self.FC1(z))
-        z = self.BN2(self.FC2(z))
-        z = z.unsqueeze(1)
-        z = self.MHSA(z, z, z)
-        z = z.squeeze(1)
+        if self._fused_weight is not None and not self.training:
+            z = F.linear(torch.cat([z, view_angle, yaw], dim=1), self._fused_weight, self._fused_bias)
+        else:
+            z = self._encode_cond(z, view_angle, yaw)
 
         samples = self.diffusion.sample(num_points, context=z, flexibility=flexibility)
         return samples
@@ -42,6 +42,7 @@ parser.add_argument('--categories', type=str_list, default=['airplane'])
 parser.add_argument('--scale_mode', type=str, default='shape_unit')
 parser.add_argument('--train_batch_size', type=int, default=128)
 parser.add_argument('--val_batch_size', type=int, default=64)
+parser.add_argument('--defer_normalize', type=eval, default=False, choices=[True, False])
 
 # Optimizer and scheduler
 parser.add_argument('--lr', type=float, default=1e-4)
@@ -85,6 +86,7 @@ train_dset = ShapeNetCore(
     cates=args.categories,
     split='train',
     scale_mode=args.scale_mode,
+    normalize=not args.defer_normalize,
 )
 val_dset = ShapeNetCore(
     path=args.dataset_path,
@@ -128,6 +130,9 @@ scheduler = get_linear_scheduler(
 def train(it):
     # Load data
     batch = next(train_iter)
+    if args.defer_normalize:
+        # Normalize the raw point clouds on the device instead of at load time
+        batch = normalize_batch(batch, device=args.device)
     x = batch['pointcloud'].to(args.device)
 
     # Reset grad and model state
@@ -36,14 +36,20 @@ parser.add_argument('--sample_num_points', type=int, default=2048)
 parser.add_argument('--kl_weight', type=float, default=0.001)
 parser.add_argument('--residual', type=eval, default=True, choices=[True, False])
 parser.add_argument('--spectral_norm', type=eval, default=False, choices=[True, False])
+parser.add_argument('--compile', type=eval, default=False, choices=[True, False])
+parser.add_argument('--amp', type=eval, default=False, choices=[True, False])
+parser.add_argument('--tf32', type=eval, default=True, choices=[True, False])
 parser.add_argument('--ckpt', type=str, default=None)
 
 # Datasets and loaders
 parser.add_argument('--dataset_path', type=str, default='./data/pandaset.pkl')
 parser.add_argument('--category', type=str, default='car')
 parser.add_argument('--scale_mode', type=str, default='shape_unit')
+parser.add_argument('--storage_dtype', type=str, default='float32', choices=['float32', 'bfloat16', 'float16'])
 parser.add_argument('--train_batch_size', type=int, default=128)
 parser.add_argument('--val_batch_size', type=int, default=64)
+parser.add_argument('--num_workers', type=int, default=4)
+parser.add_argument('--prefetch_factor', type=int, default=4)
 
 # Optimizer and scheduler
 parser.add_argument('--lr', type=float, default=1e-4)
@@ -57,6 +63,7 @@ parser.add_argument('--sched_end_epoch', type=int, default=400*THOUSAND)
 parser.add_argument('--seed', type=int, default=2020)
 parser.add_argument('--logging', type=eval, default=True, choices=[True, False])
 parser.add_argument('--log_root', type=str, default='./logs_gen')
+parser.add_argument('--log_freq', type=int, default=1)
 parser.add_argument('--device', type=str, default='cuda')
 parser.add_argument('--max_iters', type=int, default=2000000)
 parser.add_argument('--val_freq', type=int, default=1000)
@@ -66,6 +73,10 @@ parser.add_argument('--tag', type=str, default=None)
 args = parser.parse_args()
 seed_all(args.seed)
 
+# TF32 tensor-core matmuls/convolutions on Ampere and newer GPUs
+torch.backends.cuda.matmul.allow_tf32 = args.tf32
+torch.backends.cudnn.allow_tf32 = args.tf32
+
 if args.device == 'cuda':
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
     num_gpus = torch.cuda.device_count()
@@ -73,6 +84,10 @@ if args.device == 'cuda':
 else:
     device = torch.device("cpu")
     num_gpus = 1
+if args.compile and num_gpus > 1:
+    # DataParallel re-replicates the model on every forward, defeating the compiled graph
+    print('Disabling --compile: not supported with DataParallel over %d GPUs.' % num_gpus)
+    args.compile = False
 
 # Logging
 if args.logging:
@@ -95,17 +110,23 @@ train_dset = PandaSet(
     cls=args.category,
     split='train',
     scale_mode=args.scale_mode,
+    dtype=getattr(torch, args.storage_dtype),
 )
 val_dset = PandaSet(
     path=args.dataset_path,
     cls=args.category,
     split='val',
     scale_mode=args.scale_mode,
+    dtype=getattr(torch, args.storage_dtype),
 )
+# Pinned batches let the host-to-device copies below run asynchronously
+loader_kwargs = {'persistent_workers': True, 'prefetch_factor': args.prefetch_factor} if args.num_workers > 0 else {}
 train_iter = get_data_iterator(DataLoader(
     train_dset,
     batch_size=args.train_batch_size,
-    num_workers=0,
+    num_workers=args.num_workers,
+    pin_memory=(args.device == 'cuda'),
+    **loader_kwargs
 ))
 
 # Model
@@ -141,9 +162,9 @@ scheduler = get_linear_scheduler(
 def train(it):
     # Load data
     batch = next(train_iter)
-    x = batch['pointcloud'].float().to(args.device)
-    view_angle = batch['view_angle'].float().to(args.device)
-    yaw = batch['yaw'].float().to(args.device)
+    x = batch['pointcloud'].to(args.device, non_blocking=True).float()
+    view_angle = batch['view_angle'].to(args.device, non_blocking=True).float()
+    yaw = batch['yaw'].to(args.device, non_blocking=True).float()
 
     # Reset grad and model state
     optimizer.zero_grad()
@@ -185,7 +206,7 @@ def test(it):
     for i, data in enumerate(val_dset):
         if i >= args.test_size:
             break
-        ref_pcs.append(data['pointcloud'].unsqueeze(0))
+        ref_pcs.append(data['pointcloud'].float().unsqueeze(0))
         ref_yaw_angle.append(data['yaw'].unsqueeze(0))
         ref_view_angle.append(data['view_angle'].unsqueeze(0))
         
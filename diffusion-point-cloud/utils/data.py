@@ -22,6 +22,20 @@ def get_train_val_test_loaders(dataset, train_ratio, val_ratio, train_batch_size
     return train_loader, val_loader, test_loader
 
 
+def normalize_batch(batch, device=None):
+    """Applies `(pointcloud - shift) / scale` to a collated batch from a dataset built with
+    `normalize=False`, after optionally moving the tensors to `device`.
+    """
+    pc, shift, scale = batch['pointcloud'], batch['shift'], batch['scale']
+    if device is not None:
+        pc = pc.to(device, non_blocking=True)
+        shift = shift.to(device, non_blocking=True)
+        scale = scale.to(device, non_blocking=True)
+    batch['pointcloud'] = (pc - shift) / scale  # (B, N, 3) against (B, 1, 3) and (B, 1, 1)
+    batch['shift'], batch['scale'] = shift, scale
+    return batch
+
+
 def get_data_iterator(iterable):
     """Allows training with DataLoaders in a single infinite loop:
         for i, data in enumerate(inf_generator(train_loader)):
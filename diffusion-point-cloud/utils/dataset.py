@@ -1,6 +1,4 @@
 import os
-import random
-from copy import copy
 import torch
 import pickle as pkl
 from torch.utils.data import Dataset
@@ -35,11 +33,47 @@ synsetid_to_cate = {
 cate_to_synsetid = {v: k for k, v in synsetid_to_cate.items()}
 
 
+def get_shift_scale(pcs, scale_mode, stats=None):
+    """
+    Args:
+        pcs:  Point clouds, (B, N, 3).
+    Returns:
+        Per-shape shift (B, 1, 3) and scale (B, 1, 1) for the given scale mode.
+    """
+    B = pcs.size(0)
+    if scale_mode == 'global_unit':
+        shift = pcs.mean(dim=1, keepdim=True)
+        scale = stats['std'].reshape(1, 1, 1).expand(B, 1, 1)
+    elif scale_mode == 'shape_unit':
+        shift = pcs.mean(dim=1, keepdim=True)
+        scale = pcs.std(dim=(1, 2), keepdim=True)
+    elif scale_mode == 'shape_half':
+        shift = pcs.mean(dim=1, keepdim=True)
+        scale = pcs.std(dim=(1, 2), keepdim=True) / (0.5)
+    elif scale_mode == 'shape_34':
+        shift = pcs.mean(dim=1, keepdim=True)
+        scale = pcs.std(dim=(1, 2), keepdim=True) / (0.75)
+    elif scale_mode == 'shape_bbox':
+        pc_min, pc_max = torch.aminmax(pcs, dim=1, keepdim=True) # (B, 1, 3)
+        shift = (pc_min + pc_max) / 2
+        scale = (pc_max - pc_min).max(dim=2, keepdim=True)[0] / 2
+    else:
+        shift = torch.zeros([B, 1, 3], dtype=pcs.dtype)
+        scale = torch.ones([B, 1, 1], dtype=pcs.dtype)
+    return shift, scale
+
+
 class ShapeNetCore(Dataset):
 
     GRAVITATIONAL_AXIS = 1
     
-    def __init__(self, path, cates, split, scale_mode, transform=None):
+    def __init__(self, path, cates, split, scale_mode, transform=None, normalize=True, dtype=torch.float32):
+        """
+        With `normalize=False` the raw point clouds are stored and returned alongside their
+        shift/scale; apply them to collated batches with `utils.data.normalize_batch`.
+        `dtype` is the storage type of the point clouds, e.g. `torch.bfloat16` to halve
+        host memory and transfer size; upcast after moving batches to the device.
+        """
         super().__init__()
         assert isinstance(cates, list), '`cates` must be a list of cate names.'
         assert split in ('train', 'val', 'test')
@@ -52,14 +86,27 @@ class ShapeNetCore(Dataset):
         self.split = split
         self.scale_mode = scale_mode
         self.transform = transform
-
-        self.pointclouds = []
+        self.normalize = normalize
+        self.dtype = dtype
+
+        # Per-sample fields stored as stacked tensors (M, ...)
+        self.pointclouds = None
+        self.shifts = None
+        self.scales = None
+        self.cates = []
+        self.ids = []
+        self.perm = None    # Shuffled sample order, applied in `__getitem__`
         self.stats = None
 
-        self.get_statistics()
-        self.load()
+        # Share one handle (and its chunk cache) between the statistics and load passes
+        with h5py.File(self.path, 'r', rdcc_nbytes=256<<20, rdcc_nslots=10007) as f:
+            self.get_statistics(f)
+            self.load(f)
 
-    def get_statistics(self):
+        # Deterministically shuffle the dataset
+        self.perm = np.random.default_rng(2020).permutation(len(self.ids)).astype(np.int64)
+
+    def get_statistics(self, f):
 
         basename = os.path.basename(self.path)
         dsetname = basename[:basename.rfind('.')]
@@ -74,82 +121,83 @@ class ShapeNetCore(Dataset):
             self.stats = torch.load(stats_save_path)
             return self.stats
 
-        with h5py.File(self.path, 'r') as f:
-            pointclouds = []
-            for synsetid in self.cate_synsetids:
-                for split in ('train', 'val', 'test'):
-                    pointclouds.append(torch.from_numpy(f[synsetid][split][...]))
-
-        all_points = torch.cat(pointclouds, dim=0) # (B, N, 3)
-        B, N, _ = all_points.size()
-        mean = all_points.view(B*N, -1).mean(dim=0) # (1, 3)
-        std = all_points.view(-1).std(dim=0)        # (1, )
+        # Accumulate running sums chunk by chunk instead of materializing all points
+        count = 0
+        total = np.zeros([3], dtype=np.float64)
+        total_sq = 0.
+        for synsetid in self.cate_synsetids:
+            for split in ('train', 'val', 'test'):
+                ds = f[synsetid][split]
+                step = ds.chunks[0] if ds.chunks is not None else ds.shape[0]
+                for i in range(0, ds.shape[0], max(step, 1)):
+                    batch = ds[i:i+step].reshape(-1, 3).astype(np.float64)
+                    count += batch.shape[0]
+                    total += batch.sum(axis=0)
+                    total_sq += np.square(batch).sum()
+
+        n = count * 3
+        mean = torch.from_numpy(total / count).float()  # (3, )
+        var = (total_sq - total.sum() ** 2 / n) / (n - 1)
+        std = torch.tensor(np.sqrt(var)).float()        # (1, )
 
         self.stats = {'mean': mean, 'std': std}
         torch.save(self.stats, stats_save_path)
         return self.stats
 
-    def load(self):
-
-        def _enumerate_pointclouds(f):
-            for synsetid in self.cate_synsetids:
-                cate_name = synsetid_to_cate[synsetid]
-                for j, pc in enumerate(f[synsetid][self.split]):
-                    yield torch.from_numpy(pc), j, cate_name
-        
-        with h5py.File(self.path, mode='r') as f:
-            for pc, pc_id, cate_name in _enumerate_pointclouds(f):
-
-                if self.scale_mode == 'global_unit':
-                    shift = pc.mean(dim=0).reshape(1, 3)
-                    scale = self.stats['std'].reshape(1, 1)
-                elif self.scale_mode == 'shape_unit':
-                    shift = pc.mean(dim=0).reshape(1, 3)
-                    scale = pc.flatten().std().reshape(1, 1)
-                elif self.scale_mode == 'shape_half':
-                    shift = pc.mean(dim=0).reshape(1, 3)
-                    scale = pc.flatten().std().reshape(1, 1) / (0.5)
-                elif self.scale_mode == 'shape_34':
-                    shift = pc.mean(dim=0).reshape(1, 3)
-                    scale = pc.flatten().std().reshape(1, 1) / (0.75)
-                elif self.scale_mode == 'shape_bbox':
-                    pc_max, _ = pc.max(dim=0, keepdim=True) # (1, 3)
-                    pc_min, _ = pc.min(dim=0, keepdim=True) # (1, 3)
-                    shift = ((pc_min + pc_max) / 2).view(1, 3)
-                    scale = (pc_max - pc_min).max().reshape(1, 1) / 2
-                else:
-                    shift = torch.zeros([1, 3])
-                    scale = torch.ones([1, 1])
-
-                pc = (pc - shift) / scale
-
-                self.pointclouds.append({
-                    'pointcloud': pc,
-                    'cate': cate_name,
-                    'id': pc_id,
-                    'shift': shift,
-                    'scale': scale
-                })
-
-        # Deterministically shuffle the dataset
-        self.pointclouds.sort(key=lambda data: data['id'], reverse=False)
-        random.Random(2020).shuffle(self.pointclouds)
+    def load(self, f):
+
+        pointclouds, shifts, scales = [], [], []
+        for synsetid in self.cate_synsetids:
+            cate_name = synsetid_to_cate[synsetid]
+            pcs = torch.from_numpy(f[synsetid][self.split][...])  # (B, N, 3)
+            shift, scale = get_shift_scale(pcs, self.scale_mode, self.stats)
+            pointclouds.append((pcs - shift) / scale if self.normalize else pcs)
+            shifts.append(shift)
+            scales.append(scale)
+            self.cates += [cate_name] * pcs.size(0)
+            self.ids += list(range(pcs.size(0)))
+
+        self.pointclouds = torch.cat(pointclouds, dim=0).to(self.dtype)  # (M, N, 3)
+        self.shifts = torch.cat(shifts, dim=0)                     # (M, 1, 3)
+        if self.scale_mode == 'global_unit':
+            # One scale shared by every shape; keep it as a broadcast view instead of M copies
+            self.scales = self.stats['std'].reshape(1, 1, 1).expand(len(self.pointclouds), 1, 1)
+        else:
+            self.scales = torch.cat(scales, dim=0)                 # (M, 1, 1)
 
     def __len__(self):
         return len(self.pointclouds)
 
     def __getitem__(self, idx):
-        data = {k:v.clone() if isinstance(v, torch.Tensor) else copy(v) for k, v in self.pointclouds[idx].items()}
+        idx = int(self.perm[idx])
+        # Views into the stored tensors; only copy when a transform might modify them in place
+        data = {
+            'pointcloud': self.pointclouds[idx],
+            'cate': self.cates[idx],
+            'id': self.ids[idx],
+            'shift': self.shifts[idx],
+            'scale': self.scales[idx]
+        }
         if self.transform is not None:
+            data = {k:v.clone() if isinstance(v, torch.Tensor) else v for k, v in data.items()}
             data = self.transform(data)
         return data
 
 
+# Bump whenever the layout of the PandaSet cache files changes
+# 2: data caches hold rows in load order; shuffling is applied through `perm`
+PANDASET_CACHE_VERSION = 2
+
+
 class PandaSet(Dataset):
 
     GRAVITATIONAL_AXIS = 1
     
-    def __init__(self, path, cls, split, scale_mode, transform=None, input_size=1024):
+    def __init__(self, path, cls, split, scale_mode, transform=None, input_size=1024, dtype=torch.float32):
+        """
+        `dtype` is the storage type of the point clouds, e.g. `torch.bfloat16` to halve
+        host memory and transfer size; upcast after moving batches to the device.
+        """
         super().__init__()
         assert split in ('train', 'val', 'test')
         assert scale_mode is None or scale_mode in ('global_unit', 'shape_unit', 'shape_bbox', 'shape_half', 'shape_34')
@@ -159,50 +207,76 @@ class PandaSet(Dataset):
         self.transform = transform
         self.cls = cls
         self.input_size = input_size
-
-        self.pointclouds = []
+        self.dtype = dtype
+
+        # Per-sample fields stored as stacked tensors (M, ...)
+        self.pointclouds = None
+        self.view_angles = None
+        self.yaws = None
+        self.ids = []
+        self.perm = None    # Shuffled sample order, applied in `__getitem__`
         self.stats = None
 
         self.get_statistics()
         self.load()
 
-    def normalize_point_cloud(self, pc, mode='shape_unit'):
-        if mode == 'shape_unit':
-            shift = pc.mean(dim=0).reshape(1, 3)
-            scale = pc.flatten().std().reshape(1, 1)
-        elif mode == 'shape_bbox':
-            pc_max, _ = pc.max(dim=0, keepdim=True) # (1, 3)
-            pc_min, _ = pc.min(dim=0, keepdim=True) # (1, 3)
-            shift = ((pc_min + pc_max) / 2).view(1, 3)
-            scale = (pc_max - pc_min).max().reshape(1, 1) / 2
-        pc = (pc - shift) / scale
-        return pc
+        # Deterministically shuffle the dataset
+        self.perm = np.random.default_rng(2020).permutation(len(self.ids)).astype(np.int64)
 
-    def get_statistics(self):
+    def stack_points(self, objs):
+        # Objects are stored as one (B, N, 3) tensor, so every object must have the same N
+        sizes = {obj['points'].shape[0] for obj in objs}
+        assert len(sizes) <= 1, 'PandaSet objects of class %s have varying point counts %s; resample them to a common size.' % (self.cls, sorted(sizes))
+        return torch.from_numpy(np.stack([obj['points'] for obj in objs]))
 
+    def get_stats_dir(self):
         basename = os.path.basename(self.path)
         dsetname = basename[:basename.rfind('.')]
         stats_dir = os.path.join(os.path.dirname(self.path), dsetname + '_stats')
         os.makedirs(stats_dir, exist_ok=True)
+        return stats_dir
+
+    def get_source_key(self):
+        # Identifies the pickle and cache format a cache file was built from
+        st = os.stat(self.path)
+        return {'version': PANDASET_CACHE_VERSION, 'mtime_ns': st.st_mtime_ns, 'size': st.st_size}
+
+    def load_cache(self, cache_path, mmap=False):
+        """
+        Returns the cached payload, or None if it is missing or was built from a different
+        source file or cache format.
+        """
+        if not os.path.exists(cache_path):
+            return None
+        try:
+            cache = torch.load(cache_path, mmap=mmap) if mmap else torch.load(cache_path)
+        except TypeError:   # `mmap` requires torch >= 2.1
+            cache = torch.load(cache_path)
+        if not isinstance(cache, dict) or cache.get('source') != self.get_source_key():
+            return None
+        return cache
+
+    def get_statistics(self):
 
-        stats_save_path = os.path.join(stats_dir, 'stats_' + '_'.join(self.cls) + '.pt')
+        stats_save_path = os.path.join(self.get_stats_dir(), 'stats_' + '_'.join(self.cls) + '.pt')
+        cache = self.load_cache(stats_save_path)
+        if cache is not None:
+            self.stats = cache['stats']
+            return self.stats
 
         with open(self.path, 'rb') as f:
             data = pkl.load(f)
-            pointclouds = []
-            rel_distance = []
-            for split in ('train', 'val', 'test'):
-                for obj in data[self.cls][split]:
-                    rel_distance.append(torch.norm(torch.from_numpy(obj['points'])- torch.Tensor(obj['box']['position']), dim=1).reshape(-1, 1))
-                    pointclouds.append(self.normalize_point_cloud(torch.from_numpy(obj['points'])))
+        objs = [obj for split in ('train', 'val', 'test') for obj in data[self.cls][split]]
 
-        all_points = torch.cat(pointclouds, dim=0) # (B, N, 3)
-        rel_distance = torch.cat(rel_distance, dim=0)
-        N, _ = all_points.size()
+        pcs = self.stack_points(objs)                                             # (B, N, 3)
+        pos = torch.Tensor([obj['box']['position'] for obj in objs])              # (B, 3)
+        rel_distance = torch.linalg.vector_norm(pcs - pos.unsqueeze(1), dim=2)    # (B, N)
+        shift, scale = get_shift_scale(pcs, 'shape_unit')
+        all_points = ((pcs - shift) / scale).view(-1, 3)  # (B*N, 3)
         mean = all_points.mean(dim=0) # (1, 3)
         std = all_points.view(-1).std(dim=0)   # (1, )
         self.stats = {'mean': mean, 'std': std, 'mean_dist_from_center': rel_distance.mean(), 'std_dist_from_center': rel_distance.std()}
-        torch.save(self.stats, stats_save_path)
+        torch.save({'source': self.get_source_key(), 'stats': self.stats}, stats_save_path)
         return self.stats
 
     def get_features_from_pc(self, obj):
@@ -212,80 +286,73 @@ class PandaSet(Dataset):
         rel_pc = pc - pos
 
         # # Compute point cloud as relative to the object center in spherical coordinates
-        r = torch.norm(rel_pc, dim=1).reshape(-1, 1) # (N, 1)
-        theta = torch.atan2(rel_pc[:, 1], rel_pc[:, 0]).reshape(-1, 1) # (N, 1)
-        phi = torch.acos(rel_pc[:, 2] / r.flatten()).reshape(-1, 1) # (N, 1)
+        r = rel_pc.norm(dim=1, keepdim=True) # (N, 1)
+        theta = torch.atan2(rel_pc[:, 1:2], rel_pc[:, 0:1]) # (N, 1)
+        phi = torch.acos(rel_pc[:, 2:3] / r) # (N, 1)
 
         # Normalize
         r = (r - self.stats['mean_dist_from_center']) / self.stats['std_dist_from_center']
         theta = (theta) / (np.pi/2)
         phi = (phi) / np.pi
-        breakpoint()
 
         return torch.cat([r, theta, phi], dim=1)
 
     def load(self):
 
+        # Preprocessed tensors are cached per class/split/scale mode and memory-mapped on reload
+        cache_path = os.path.join(self.get_stats_dir(), 'data_%s_%s_%s.pt' % (self.cls, self.split, self.scale_mode))
+        cache = self.load_cache(cache_path, mmap=True)
+        if cache is not None:
+            self.pointclouds = cache['pointclouds'].to(self.dtype)
+            self.view_angles = cache['view_angles']
+            self.yaws = cache['yaws']
+            self.ids = cache['ids']
+            return
+
         with open(self.path, 'rb') as f:
             data = pkl.load(f)
-  
-        for pc_id, obj in enumerate(data[self.cls][self.split]):
-            
-            # pc = self.get_features_from_pc(obj)
-
-            pc = torch.from_numpy(obj['points'])
-            pos = torch.Tensor(obj['box']['position'])
-            pc = pc - pos
-                
-            if self.scale_mode == 'global_unit':
-                shift = pc.mean(dim=0).reshape(1, 3)
-                scale = self.stats['std'].reshape(1, 1)
-            elif self.scale_mode == 'shape_unit':
-                shift = pc.mean(dim=0).reshape(1, 3)
-                scale = pc.flatten().std().reshape(1, 1)
-            elif self.scale_mode == 'shape_half':
-                shift = pc.mean(dim=0).reshape(1, 3)
-                scale = pc.flatten().std().reshape(1, 1) / (0.5)
-            elif self.scale_mode == 'shape_34':
-                shift = pc.mean(dim=0).reshape(1, 3)
-                scale = pc.flatten().std().reshape(1, 1) / (0.75)
-            elif self.scale_mode == 'shape_bbox':
-                pc_max, _ = pc.max(dim=0, keepdim=True) # (1, 3)
-                pc_min, _ = pc.min(dim=0, keepdim=True) # (1, 3)
-                shift = ((pc_min + pc_max) / 2).view(1, 3)
-                scale = (pc_max - pc_min).max().reshape(1, 1) / 2
-            else:
-                shift = torch.zeros([1, 3])
-                scale = torch.ones([1, 1])
-
-            pc = (pc - shift) / scale
-            yaw = (torch.Tensor([obj['box']['yaw']]) - np.pi/2)
-
-            #normalize yaw between -pi and pi
-            def normalize_angle(angle):
-                # Normalize angle to be within the range [-pi, pi]
-                normalized_angle = (angle + np.pi) % (2 * np.pi) - np.pi
-                return normalized_angle
-
-            self.pointclouds.append({
-                'pointcloud': pc,
-                'view_angle': torch.Tensor([obj['box']['view_angle']]) / np.pi,
-                'yaw': normalize_angle(yaw) / np.pi,
-                'cate': self.cls,
-                'id': pc_id,
-                'shift': self.stats['mean_dist_from_center'],
-                'scale': self.stats['std_dist_from_center']
-            })
-
-        # Deterministically shuffle the dataset
-        self.pointclouds.sort(key=lambda data: data['id'], reverse=False)
-        random.Random(2020).shuffle(self.pointclouds)
+        objs = data[self.cls][self.split]
+
+        pcs = self.stack_points(objs)                                         # (B, N, 3)
+        pos = torch.Tensor([obj['box']['position'] for obj in objs])          # (B, 3)
+        pcs = pcs - pos.unsqueeze(1)
+        shift, scale = get_shift_scale(pcs, self.scale_mode, self.stats)
+        pcs = (pcs - shift) / scale
+
+        view_angles = torch.Tensor([[obj['box']['view_angle']] for obj in objs]) / np.pi  # (B, 1)
+        yaws = torch.Tensor([[obj['box']['yaw']] for obj in objs]) - np.pi/2             # (B, 1)
+        # Normalize yaw to be within the range [-pi, pi]
+        yaws = ((yaws + np.pi) % (2 * np.pi) - np.pi) / np.pi
+        pcs = pcs.float()               # (M, N, 3)
+        self.pointclouds = pcs.to(self.dtype)
+        self.view_angles = view_angles  # (M, 1)
+        self.yaws = yaws                # (M, 1)
+        self.ids = list(range(len(objs)))
+
+        torch.save({
+            'source': self.get_source_key(),
+            'pointclouds': pcs,
+            'view_angles': self.view_angles,
+            'yaws': self.yaws,
+            'ids': self.ids
+        }, cache_path)
 
     def __len__(self):
         return len(self.pointclouds)
 
     def __getitem__(self, idx):
-        data = {k:v.clone() if isinstance(v, torch.Tensor) else copy(v) for k, v in self.pointclouds[idx].items()}
+        idx = int(self.perm[idx])
+        # Views into the stored tensors; only copy when a transform might modify them in place
+        data = {
+            'pointcloud': self.pointclouds[idx],
+            'view_angle': self.view_angles[idx],
+            'yaw': self.yaws[idx],
+            'cate': self.cls,
+            'id': self.ids[idx],
+            'shift': self.stats['mean_dist_from_center'],
+            'scale': self.stats['std_dist_from_center']
+        }
         if self.transform is not None:
+            data = {k:v.clone() if isinstance(v, torch.Tensor) else v for k, v in data.items()}
             data = self.transform(data)
         return data